@@ -2,12 +2,14 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import configuration
+from . import product
 from . import sale
 
 
 def register():
     Pool.register(
         configuration.SaleConfiguration,
+        product.ProductIdentifier,
         sale.Sale,
         sale.SaleLine,
         sale.Cron,
@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.i18n import gettext
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, Not
+from trytond.exceptions import UserError
+
+from .edi import parse_sender_quotas
 
 
 class SaleConfiguration(metaclass=PoolMeta):
@@ -12,6 +17,33 @@ class SaleConfiguration(metaclass=PoolMeta):
     edi_source_path = fields.Char('Source Path')
     edi_errors_path = fields.Char('Errors Path')
     template_sale_edi = fields.Char('Template EDI Used for Sale')
+    edi_priority = fields.Selection([
+            (None, 'Directory Order'),
+            ('urgency', 'Urgency First'),
+            ('size', 'Small Files First'),
+            ], 'Processing Priority',
+        help='Order in which the EDI files of the source path are processed.\n'
+        '"Urgency First" processes first the orders with the earliest '
+        'requested delivery date.\n'
+        '"Small Files First" processes first the orders with fewer lines.')
+    edi_sender_quotas = fields.Text('Sender Quotas',
+        help='Number of files processed in each turn for the senders, one '
+        '"sender=quota" by line. The senders not defined have a quota of 1.')
+    edi_sender_parallel = fields.Boolean('Process Senders in Parallel',
+        help='Process the files of each sender in its own task of the queue.')
+    edi_reserve_numbers = fields.Boolean('Reserve Sale Numbers',
+        help='Number the EDI sales when they are imported, reserving the '
+        'numbers of each batch at once so the sale sequence is not locked '
+        'during the import.')
+    edi_profile = fields.Boolean('Profile Slow Files',
+        help='Save the profile of the EDI files which take longer than the '
+        'threshold to be imported next to the error files.')
+    edi_profile_threshold = fields.Float('Profile Threshold',
+        states={
+            'invisible': Not(Eval('edi_profile', False)),
+            'required': Eval('edi_profile', False),
+            },
+        help='Time in seconds from which the profile of a file is saved.')
 
     @staticmethod
     def default_edi_source_path():
@@ -20,3 +52,30 @@ class SaleConfiguration(metaclass=PoolMeta):
     @staticmethod
     def default_edi_errors_path():
         return '/tmp/'
+
+    @staticmethod
+    def default_edi_profile_threshold():
+        return 5.0
+
+    @classmethod
+    def validate(cls, configurations):
+        super(SaleConfiguration, cls).validate(configurations)
+        for configuration in configurations:
+            configuration.check_edi_sender_quotas()
+
+    def check_edi_sender_quotas(self):
+        try:
+            parse_sender_quotas(self.edi_sender_quotas)
+        except ValueError as e:
+            raise UserError(gettext(
+                    'sale_edi_electronet.msg_invalid_edi_sender_quota',
+                    line=str(e)))
+
+    @classmethod
+    def process_edi_sender_files(cls, configurations, sender, files,
+            errors_path, template_name=None):
+        "Queue task creating the sales of the EDI files of a sender"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Sale.process_edi_sender_files(sender, files, errors_path,
+            template_name=template_name)
@@ -0,0 +1,460 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import os
+import sys
+import threading
+from collections import Counter, namedtuple
+from functools import wraps
+from itertools import islice
+
+from edifact.errors import IncorrectValueForField, MissingFieldsError
+from edifact.utils import validate_segment, with_segment_check
+
+__all__ = ['EdiHeader', 'peek_edi_header', 'SegmentValidator',
+    'compile_segment', 'compile_template', 'get_compiled_template',
+    'with_compiled_check', 'ReferenceMap', 'EdiReferences',
+    'parse_sender_quotas', 'interleave_by_sender', 'EdiDataManager',
+    'StackSampler']
+
+logger = logging.getLogger(__name__)
+
+EdiHeader = namedtuple('EdiHeader', ['delivery_date', 'lines', 'sender'])
+
+DEFAULT_SEPARATORS = {
+    'component': ':',
+    'element': '+',
+    'segment': "'",
+    }
+
+
+def get_separators(data):
+    "Return the separators of the interchange, defined by the UNA segment"
+    separators = DEFAULT_SEPARATORS.copy()
+    if data.startswith('UNA') and len(data) >= 9:
+        separators['component'] = data[3]
+        separators['element'] = data[4]
+        separators['segment'] = data[8]
+    return separators
+
+
+def _peek_element(data, tag, index, separators, end=None):
+    "Return the first component of an element of the first segment with tag"
+    segment = separators['segment']
+    start = data.find(segment + tag, 0, end)
+    if start < 0:
+        return
+    stop = data.find(segment, start + 1)
+    elements = data[start + 1:stop if stop > 0 else None].split(
+        separators['element'])
+    if len(elements) > index:
+        return elements[index].split(separators['component'])[0] or None
+
+
+def peek_edi_header(data):
+    """
+    Return the requested delivery date (DTM+2), the number of lines and the
+    sender (UNB or NAD+MS) of an ORDERS message without parsing it.
+    """
+    separators = get_separators(data)
+    element = separators['element']
+    segment = separators['segment']
+    lin = segment + 'LIN' + element
+    # Ignore the new lines which may follow the segment terminator
+    data = data.replace('\r', '').replace(segment + '\n', segment)
+
+    lines = data.count(lin)
+    end = data.find(lin)
+    if end < 0:
+        end = len(data)
+    delivery_date = None
+    dtm = segment + 'DTM' + element + '2' + separators['component']
+    start = data.find(dtm, 0, end)
+    if start >= 0:
+        start += len(dtm)
+        stop = data.find(separators['component'], start, end)
+        if stop > start:
+            delivery_date = data[start:stop]
+    # The UNB segment may be the first one, without terminator before it
+    sender = (_peek_element(segment + data, 'UNB' + element, 2, separators)
+        or _peek_element(data, 'NAD' + element + 'MS' + element, 2,
+            separators, end))
+    return EdiHeader(delivery_date, lines, sender)
+
+
+class SegmentMismatch(Exception):
+    "The segment doesn't match the fast path of a compiled validator"
+
+
+class SegmentValidator(object):
+    """
+    Validator of a segment compiled from its template.
+
+    Calling it with the elements of a segment returns a tuple with the
+    elements marked as '!value' and the elements with a choice of values,
+    in the order of the template. When the segment doesn't match, the
+    template is interpreted by validate_segment, so the raised errors are
+    the same of edifact.
+    """
+    __slots__ = ('template', '_validate')
+
+    def __init__(self, template):
+        self.template = template
+        self._validate = _compile_segment(template)
+
+    def __call__(self, elements):
+        try:
+            return self._validate(elements)
+        except (SegmentMismatch, IndexError, TypeError):
+            validate_segment(elements, self.template)
+            values = []
+            _extract_values(elements, self.template, values)
+            return tuple(values)
+
+
+def _compile_elements(template, name, lines, namespace, values, indent):
+    for index, item in enumerate(template):
+        element = '{}_{}'.format(name, index)
+        if isinstance(item, list):
+            lines.append('{}{} = {}[{}]'.format(indent, element, name, index))
+            lines.append('{}if ({}.__class__ is not list or len({}) < {}):'
+                .format(indent, element, element, len(item)))
+            lines.append('{}    raise SegmentMismatch'.format(indent))
+            _compile_elements(item, element, lines, namespace, values,
+                indent)
+        elif item == '!value':
+            lines.append('{}{} = {}[{}]'.format(indent, element, name, index))
+            lines.append('{}if not {}:'.format(indent, element))
+            lines.append('{}    raise SegmentMismatch'.format(indent))
+            values.append(element)
+        elif item == '!ignore':
+            continue
+        elif isinstance(item, tuple):
+            constant = 'c{}'.format(len(namespace))
+            namespace[constant] = item
+            lines.append('{}{} = {}[{}]'.format(indent, element, name, index))
+            lines.append('{}if {} not in {}:'.format(indent, element,
+                    constant))
+            lines.append('{}    raise SegmentMismatch'.format(indent))
+            values.append(element)
+        else:
+            # The empty positions must be empty too, any other value is left
+            # to validate_segment
+            constant = 'c{}'.format(len(namespace))
+            namespace[constant] = item
+            lines.append('{}if {}[{}] != {}:'.format(indent, name, index,
+                    constant))
+            lines.append('{}    raise SegmentMismatch'.format(indent))
+
+
+def _compile_segment(template):
+    "Return a function which validates the elements of a segment"
+    namespace = {'SegmentMismatch': SegmentMismatch}
+    lines, values = [], []
+    indent = ' ' * 4
+    lines.append('def validate(e):')
+    lines.append('{}if len(e) < {}:'.format(indent, len(template)))
+    lines.append('{}    raise SegmentMismatch'.format(indent))
+    _compile_elements(template, 'e', lines, namespace, values, indent)
+    lines.append('{}return ({})'.format(indent,
+            ''.join('{}, '.format(v) for v in values)))
+    exec('\n'.join(lines), namespace)
+    return namespace['validate']
+
+
+def _extract_values(elements, template, values):
+    for index, item in enumerate(template):
+        try:
+            element = elements[index]
+        except (IndexError, TypeError):
+            element = None
+        if isinstance(item, list):
+            _extract_values(element if isinstance(element, list) else [],
+                item, values)
+        elif item == '!value' or isinstance(item, tuple):
+            values.append(element)
+
+
+def compile_segment(template):
+    if isinstance(template, SegmentValidator):
+        return template
+    return SegmentValidator(template)
+
+
+def compile_template(template):
+    """
+    Return the validators of all the segments of an EDI template indexed by
+    section and tag
+    """
+    compiled = {}
+    for section in ('header', 'detail', 'resume'):
+        segments = template.get(section) or {}
+        compiled[section] = {tag: compile_segment(segment_template)
+            for tag, segment_template in segments.items()}
+    return compiled
+
+
+_compiled_templates = {}
+
+
+def get_compiled_template(template):
+    """
+    Return the validators of an EDI template, compiled once per template
+    instance
+    """
+    key = id(template)
+    cached = _compiled_templates.get(key)
+    if cached is None or cached[0] is not template:
+        if len(_compiled_templates) >= 16:
+            _compiled_templates.clear()
+        cached = _compiled_templates[key] = (template,
+            compile_template(template))
+    return cached[1]
+
+
+def with_compiled_check(func):
+    """
+    Decorator of the segment processing methods which validates the segment
+    with its compiled validator and calls the method with the values of the
+    segment instead of its template
+    """
+    # Segments which don't pass the validation get the errors of edifact
+    check = with_segment_check(lambda cls, segment, template: None)
+
+    @wraps(func)
+    def wrapper(cls, segment, template):
+        validator = compile_segment(template)
+        try:
+            values = validator(segment.elements)
+        except (MissingFieldsError, IncorrectValueForField):
+            return check(cls, segment, validator.template)
+        return func(cls, segment, values)
+    return wrapper
+
+
+class ReferenceMap(object):
+    """
+    Lookup map of the codes of the records used by the EDI messages.
+
+    Each record is stored with its code so it can be moved or removed when
+    the record changes.
+    """
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self):
+        self._keys = {}
+        self._values = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def set(self, record_id, key, value):
+        "Set the key and value of a record, None key removes it"
+        old_key = self._keys.pop(record_id, None)
+        if old_key is not None:
+            values = self._values[old_key]
+            values.pop(record_id, None)
+            if not values:
+                del self._values[old_key]
+        if key is not None:
+            self._keys[record_id] = key
+            self._values.setdefault(key, {})[record_id] = value
+
+    def has(self, record_id, key, value):
+        "Return if the record is already stored with the key and value"
+        if key is None:
+            return record_id not in self._keys
+        return (self._keys.get(record_id) == key
+            and self._values[key].get(record_id) == value)
+
+    def get(self, key):
+        "Return the values of the records with the key"
+        values = self._values.get(key)
+        if not values:
+            return []
+        return sorted(values.values())
+
+    def copy(self):
+        result = ReferenceMap()
+        result._keys = self._keys.copy()
+        result._values = {k: v.copy() for k, v in self._values.items()}
+        return result
+
+
+class EdiReferences(object):
+    "Lookup maps of the parties, addresses and products of a database"
+    __slots__ = ('parties', 'addresses', 'products', 'loaded', 'updated')
+
+    def __init__(self):
+        self.parties = ReferenceMap()
+        self.addresses = ReferenceMap()
+        self.products = ReferenceMap()
+        # Time of the last full load and of the last refresh
+        self.loaded = None
+        self.updated = None
+
+    def copy(self):
+        result = EdiReferences()
+        result.parties = self.parties.copy()
+        result.addresses = self.addresses.copy()
+        result.products = self.products.copy()
+        result.loaded = self.loaded
+        result.updated = self.updated
+        return result
+
+
+def parse_sender_quotas(text):
+    """
+    Return the quotas of the senders defined in text, one 'sender=quota' by
+    line. Raise ValueError with the line which is not valid.
+    """
+    quotas = {}
+    for line in (text or '').splitlines():
+        if not line.strip():
+            continue
+        sender, _, quota = line.partition('=')
+        try:
+            quota = int(quota)
+        except ValueError:
+            raise ValueError(line)
+        if not sender.strip() or quota < 1:
+            raise ValueError(line)
+        quotas[sender.strip().upper()] = quota
+    return quotas
+
+
+def interleave_by_sender(groups, quotas=None):
+    """
+    Return the (sender, items) turns of the lists of groups, indexed by
+    sender, in weighted round robin: each round takes as many items of every
+    sender as its quota, 1 by default.
+    """
+    quotas = quotas or {}
+    pending = [(sender, iter(items), quotas.get((sender or '').upper(), 1))
+        for sender, items in groups.items()]
+    result = []
+    while pending:
+        remaining = []
+        for sender, items, quota in pending:
+            chunk = list(islice(items, quota))
+            if chunk:
+                result.append((sender, chunk))
+            if len(chunk) == quota:
+                remaining.append((sender, items, quota))
+        pending = remaining
+    return result
+
+
+class EdiDataManager(object):
+    """
+    Data manager of a transaction which calls the functions of on_commit
+    once the transaction is committed and those of on_abort when it's rolled
+    back. It's joined to the transaction by Transaction().join().
+    The EDI references refreshed by the transaction are kept in references
+    until it ends.
+    """
+
+    def __init__(self):
+        self.on_commit = []
+        self.on_abort = []
+        self.references = None
+
+    def __eq__(self, other):
+        if not isinstance(other, EdiDataManager):
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        self._finish(self.on_abort)
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self._finish(self.on_commit)
+
+    def tpc_abort(self, trans):
+        self._finish(self.on_abort)
+
+    def _finish(self, functions):
+        self.on_commit, self.on_abort = [], []
+        self.references = None
+        for function in functions:
+            try:
+                function()
+            except Exception:
+                logger.exception('EDI data manager failed to call %s',
+                    function)
+
+
+class StackSampler(object):
+    """
+    Sampling profiler of a thread.
+
+    A background thread takes the stack of the profiled thread at each
+    interval, so unlike cProfile the profiled code isn't traced and doesn't
+    run slower. The cost is a short wake up of the background thread by
+    interval, and the functions which last less than the interval may not
+    be sampled.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}({})'.format(
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def get_stats(self):
+        """
+        Return the (function, total, own) samples of each function sorted by
+        total samples, the total ones include the samples of its callees
+        """
+        total, own = Counter(), Counter()
+        for stack, count in self.samples.items():
+            for function in set(stack):
+                total[function] += count
+            own[stack[-1]] += count
+        return sorted(((f, c, own[f]) for f, c in total.items()),
+            key=lambda x: (-x[1], -x[2], x[0]))
+
+    def write(self, fp, limit=50):
+        "Write the most sampled functions and the stacks to the file"
+        fp.write('Samples: {} every {:.0f}ms\n\n'.format(
+                sum(self.samples.values()), self.interval * 1000))
+        fp.write('{:>8} {:>8}  {}\n'.format('Total', 'Own', 'Function'))
+        for function, total, own in self.get_stats()[:limit]:
+            fp.write('{:>8} {:>8}  {}\n'.format(total, own, function))
+        # The stacks are written in the collapsed format of the flame graphs
+        fp.write('\nStacks:\n')
+        for stack, count in self.samples.most_common():
+            fp.write('{} {}\n'.format(';'.join(stack), count))
@@ -0,0 +1,17 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import Index
+from trytond.pool import PoolMeta
+
+
+class ProductIdentifier(metaclass=PoolMeta):
+    __name__ = 'product.identifier'
+
+    @classmethod
+    def __setup__(cls):
+        super(ProductIdentifier, cls).__setup__()
+        t = cls.__table__()
+        # EDI order lines are resolved by EAN with a single search per message,
+        # of both the EAN-13 and GTIN-14 forms of the codes
+        cls._sql_indexes.add(
+            Index(t, (t.type, Index.Equality()), (t.code, Index.Equality())))
@@ -0,0 +1,239 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Replay archived EDI ORDERS files through Sale.import_edi_input to measure the
+import and compare the created sales between versions.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .sale import KNOWN_EXTENSIONS
+
+__all__ = ['run']
+
+logger = logging.getLogger(__name__)
+
+
+def get_files(path):
+    "Return the EDI files of the directory sorted by name"
+    files = []
+    for fname in sorted(os.listdir(path)):
+        fname = os.path.join(path, fname)
+        if (os.path.splitext(fname)[1].lower() in KNOWN_EXTENSIONS
+                and os.path.isfile(fname)):
+            files.append(fname)
+    return files
+
+
+def percentile(values, percent):
+    "Return the nearest-rank percentile of the sorted values"
+    if not values:
+        return 0.0
+    rank = max(int(math.ceil(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def summarize(sale):
+    "Return the values of the sale compared between replays"
+    if not sale:
+        return None
+    return {
+        'reference': sale.reference,
+        'party': sale.party.rec_name if sale.party else None,
+        'shipment_address': (sale.shipment_address.rec_name
+            if sale.shipment_address else None),
+        'currency': sale.currency.code if sale.currency else None,
+        'lines': [[
+                line.product.code if line.product else None,
+                line.quantity,
+                line.unit.symbol if line.unit else None,
+                str(line.unit_price) if line.unit_price is not None else None,
+                ] for line in sale.lines],
+        }
+
+
+def diff(previous, current):
+    "Return the lines describing the changes between two replays"
+    lines = []
+    for fname in sorted(set(previous) | set(current)):
+        name = os.path.basename(fname)
+        if fname not in previous:
+            lines.append('{}: not replayed before'.format(name))
+            continue
+        if fname not in current:
+            lines.append('{}: not replayed'.format(name))
+            continue
+        old, new = previous[fname], current[fname]
+        if old['errors'] != new['errors']:
+            lines.append('{}: errors {} -> {}'.format(name, old['errors'],
+                    new['errors']))
+        old_sale, new_sale = old['sale'] or {}, new['sale'] or {}
+        for key in sorted(set(old_sale) | set(new_sale)):
+            if old_sale.get(key) != new_sale.get(key):
+                lines.append('{}: {} {} -> {}'.format(name, key,
+                        old_sale.get(key), new_sale.get(key)))
+    return lines
+
+
+class Replay(object):
+    "Import EDI files in separated transactions"
+
+    def __init__(self, database, user, context, template_name=None,
+            dry_run=False):
+        self.database = database
+        self.user = user
+        self.context = context
+        self.template_name = template_name
+        self.dry_run = dry_run
+        self._template = None
+        self._lock = threading.Lock()
+
+    def template(self):
+        with self._lock:
+            if self._template is None:
+                Sale = Pool().get('sale.sale')
+                self._template = Sale.get_edi_template(self.template_name)
+            return self._template
+
+    def setup(self):
+        """
+        Load the template and the EDI references before the files are
+        replayed, so their load is not measured as the latency of the first
+        ones
+        """
+        with Transaction().start(self.database, self.user,
+                context=self.context) as transaction:
+            Sale = Pool().get('sale.sale')
+            self.template()
+            Sale.preload_edi_references()
+            # The references are shared with the replays once committed
+            transaction.commit()
+
+    def __call__(self, fname, scheduled=None):
+        """
+        Import the file and return its result. The latency is measured from
+        the scheduled time, time.perf_counter() when the file was due, so it
+        includes the wait for a free worker.
+        """
+        started = time.perf_counter()
+        if scheduled is None:
+            scheduled = started
+        with Transaction().start(self.database, self.user,
+                context=self.context) as transaction:
+            pool = Pool()
+            Sale = pool.get('sale.sale')
+            template = self.template()
+            data = Sale._read_edi_file(fname)
+
+            start = time.perf_counter()
+            try:
+                sale, errors = Sale.import_edi_input(data, template)
+                if sale:
+                    Sale.save([sale])
+                    Sale.apply_on_change_product_and_quantity_to_lines(
+                        [sale])
+                result = {
+                    'errors': [str(x) for x in errors],
+                    'sale': summarize(sale),
+                    }
+            except Exception as e:
+                logger.exception('Replay of %s failed', fname)
+                transaction.rollback()
+                result = {
+                    'errors': ['{}: {}'.format(e.__class__.__name__, e)],
+                    'sale': None,
+                    }
+            else:
+                if self.dry_run:
+                    transaction.rollback()
+                else:
+                    transaction.commit()
+            end = time.perf_counter()
+            result['wait'] = started - scheduled
+            result['import'] = end - start
+            result['latency'] = end - scheduled
+            return result
+
+
+def run(options):
+    """
+    Replay the files of options.directory and print the report.
+    Return the exit status.
+    """
+    database = options.database
+    Pool(database).init()
+    with Transaction().start(database, 0, readonly=True):
+        User = Pool().get('res.user')
+        users = User.search([('login', '=', options.login)], limit=1)
+        if not users:
+            logger.error('User %s not found', options.login)
+            return 1
+        user, = users
+        user_id = user.id
+    with Transaction().start(database, user_id, readonly=True):
+        User = Pool().get('res.user')
+        context = User.get_preferences(context_only=True)
+
+    files = get_files(options.directory)
+    if not files:
+        logger.error('No EDI files found in %s', options.directory)
+        return 1
+    replay = Replay(database, user_id, context,
+        template_name=options.template, dry_run=options.dry_run)
+    replay.setup()
+
+    results = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        futures = {}
+        for index, fname in enumerate(files):
+            # Submit the files at the requested rate
+            if options.rate:
+                scheduled = start + index / options.rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            futures[fname] = executor.submit(replay, fname, scheduled)
+        for fname, future in futures.items():
+            results[fname] = future.result()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(r['latency'] for r in results.values())
+    waits = sorted(r['wait'] for r in results.values())
+    print('Files: {}{}'.format(len(results),
+            ' (dry run)' if options.dry_run else ''))
+    print('Sales: {}'.format(
+            sum(1 for r in results.values() if r['sale'])))
+    print('Files with errors: {}'.format(
+            sum(1 for r in results.values() if r['errors'])))
+    print('Throughput: {:.2f} files/s'.format(
+            len(results) / elapsed if elapsed else 0))
+    for percent in (50, 90, 95, 99, 100):
+        print('Latency p{}: {:.3f}s (wait {:.3f}s)'.format(percent,
+                percentile(latencies, percent), percentile(waits, percent)))
+
+    if options.compare:
+        with open(options.compare, 'r') as fp:
+            previous = json.load(fp)
+        # The replays are compared by file name, they may be moved
+        previous = {os.path.basename(k): v for k, v in previous.items()}
+        current = {os.path.basename(k): v for k, v in results.items()}
+        changes = diff(previous, current)
+        print('Differences with {}: {}'.format(options.compare,
+                len(changes)))
+        for line in changes:
+            print('  ' + line)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return 0
@@ -2,6 +2,10 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+from trytond.i18n import gettext
+from trytond.exceptions import UserError
 from trytond.modules.product import price_digits
 from edifact.errors import (IncorrectValueForField, MissingFieldsError)
 from edifact.message import Message
@@ -9,19 +13,71 @@ from edifact.serializer import Serializer
 from trytond.modules.edocument_unedifact.edocument import (EdifactMixin,
     UOMS_EDI_TO_TRYTON, EdiTemplate)
 
-from edifact.utils import (with_segment_check, validate_segment,
-    separate_section, RewindIterator, DO_NOTHING, NO_ERRORS)
+from edifact.utils import (separate_section, RewindIterator, DO_NOTHING,
+    NO_ERRORS)
+from .edi import (peek_edi_header, compile_segment, get_compiled_template,
+    with_compiled_check, EdiReferences, parse_sender_quotas,
+    interleave_by_sender, EdiDataManager, StackSampler)
 
 import os
-from datetime import datetime
+import logging
+import tempfile
+import time
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
+from functools import partial
+from threading import Lock
 from itertools import chain
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 
 ZERO_ = Decimal('0')
 NO_SALE = None
 KNOWN_EXTENSIONS = ['.txt', '.edi', '.pla']
 MODULE_PATH = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_TEMPLATE = 'ORDERS.yml'
+# EDI templates by file name and path with the modification time of the file
+_edi_templates = {}
+# Errors raised by the messages which don't follow the template or with
+# values which can't be converted
+EDI_INPUT_ERRORS = (IncorrectValueForField, MissingFieldsError, ValueError,
+    InvalidOperation)
+
+logger = logging.getLogger(__name__)
+
+# Lookup maps of the EDI references by database name
+_edi_references = {}
+_edi_references_lock = Lock()
+# All the references are reloaded after this time in any case
+REFERENCES_RELOAD = timedelta(days=1)
+# Records are refreshed from some time before the last refresh to get those
+# written by transactions which were running at that moment
+REFERENCES_OVERLAP = timedelta(minutes=10)
+# The references refreshed less than this time ago are used as they are
+REFERENCES_REFRESH = timedelta(minutes=1)
+# The working directories of the files claimed by the queue tasks which are
+# not modified for this time are left by failed tasks
+WORK_PATH_TIMEOUT = timedelta(hours=1)
+
+
+def remove_edi_file(fname):
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
+
+
+def move_edi_file(fname, destination):
+    try:
+        os.rename(fname, destination)
+    except FileNotFoundError:
+        pass
+
+
+def remove_edi_work_path(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
 
 
 class Cron(metaclass=PoolMeta):
@@ -37,6 +93,13 @@ class Cron(metaclass=PoolMeta):
 class Sale(EdifactMixin, metaclass=PoolMeta):
     __name__ = 'sale.sale'
 
+    @classmethod
+    def __setup__(cls):
+        super(Sale, cls).__setup__()
+        cls.__rpc__.update({
+                'import_edi_payloads': RPC(readonly=False),
+                })
+
     def set_fields_value(self, values):
         """
         Set Sale fields values from a given dict
@@ -53,6 +116,8 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
         Creates a sale record from a given edi file
         :param edi_file: EDI file to be processed.
         :template_name: File name from the file used to validate the EDI msg.
+        The sale is returned without saving, so nothing is written if the
+        message raises an error.
         """
         pool = Pool()
         SaleLine = pool.get('sale.line')
@@ -76,6 +141,8 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
                 end='UNS')]
         del(segments_iterator)
 
+        # The segments are validated by the template compiled to functions
+        validators = get_compiled_template(template)
         total_errors = []
         discard_if_partial_sale = False
         values = {}
@@ -84,7 +151,7 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
             # Ignore the tags we not use
             if segment.tag not in template['header'].keys():
                 continue
-            template_segment = template['header'].get(segment.tag)
+            template_segment = validators['header'].get(segment.tag)
             # Segment ALI has a special management, it doesn't provides
             # any value for the sale but defines if the sale will be created
             # if some requested products can't not be selled.
@@ -114,7 +181,7 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
             return NO_SALE, total_errors
 
         nad_results = {}
-        template_segment = template['header'].get(u'NAD')
+        template_segment = validators['header'].get(u'NAD')
         for segment in nad_segments:
             result, errors = cls._process_NAD(segment, template_segment)
             if errors:
@@ -150,14 +217,32 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
         if not sale.party:
             sale.party = sale.shipment_party
         sale.on_change_party()
+        products = cls._get_edi_products(detail, validators)
+        lines = []
         for linegroup in detail:
             values = {}
+            errors = []
+            ean_errors = []
             for segment in linegroup:
                 if segment.tag not in template['detail'].keys():
                     continue
-                template_segment = template['detail'].get(segment.tag)
-                process = eval('cls._process_{}LIN'.format(segment.tag))
-                to_update, errors = process(segment, template_segment)
+                template_segment = validators['detail'].get(segment.tag)
+                # The product is identified by the EAN of the LIN segment and
+                # the supplier code of the PIA segment is used as a fallback
+                if segment.tag == 'LIN':
+                    to_update, ean_errors = cls._process_LINLIN(segment,
+                        template_segment, products)
+                    if to_update:
+                        values.update(to_update)
+                    continue
+                if segment.tag == 'PIA':
+                    if values.get('product'):
+                        continue
+                    to_update, errors = cls._process_PIALIN(segment,
+                        template_segment, products)
+                else:
+                    process = eval('cls._process_{}LIN'.format(segment.tag))
+                    to_update, errors = process(segment, template_segment)
                 if errors:
                     # If there are errors the linegroup isn't processed
                     total_errors += errors
@@ -166,6 +251,9 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
                     values.update(to_update)
             if errors:
                 continue
+            if ean_errors and not values.get('product'):
+                total_errors += ean_errors
+                continue
             if (values.get('base_price', None) == 0 and
                     values.get('unit_price', None) != 0):
                 del values['base_price']
@@ -178,24 +266,25 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
                 line.base_price = values.get('base_price', ZERO_)
             if not getattr(line, 'unit_price'):
                 line.unit_price = ZERO_
-            line.save()
+            lines.append(line)
+        sale.lines = lines
         return sale, total_errors
 
     @classmethod
-    @with_segment_check
-    def _process_BGM(cls, segment, template):
-        return {'reference': segment.elements[1]}, NO_ERRORS
+    @with_compiled_check
+    def _process_BGM(cls, segment, values):
+        return {'reference': values[0]}, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_ALI(cls, segment, template):
+    @with_compiled_check
+    def _process_ALI(cls, segment, values):
         return DO_NOTHING, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_FTX(cls, segment, template):
+    @with_compiled_check
+    def _process_FTX(cls, segment, values):
         if segment and segment.elements:
-            element = segment.elements[3]
+            _, element = values
             if isinstance(element, list):
                 element = "".join(element)
             return {'comment': element}, NO_ERRORS
@@ -203,10 +292,10 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
             return DO_NOTHING, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_CTA(cls, segment, template):
+    @with_compiled_check
+    def _process_CTA(cls, segment, values):
         if segment and segment.elements:
-            element = segment.elements[1]
+            element, = values
             if isinstance(element, list):
                 element = "".join(element)
             return {'comment': element}, NO_ERRORS
@@ -214,51 +303,64 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
             return DO_NOTHING, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_COM(cls, segment, template):
+    @with_compiled_check
+    def _process_COM(cls, segment, values):
         if segment and segment.elements:
-            element = segment.elements[0][0]
+            element, channel = values
             if isinstance(element, list):
                 element = "".join(element)
-            if segment.elements[0][2] == 'TE':
+            if channel == 'TE':
                 element = "Telf: %s" % element
-            elif segment.elements[0][2] == 'FX':
+            elif channel == 'FX':
                 element = "Fax: %s" % element
-            elif segment.elements[0][2] == 'EM':
+            elif channel == 'EM':
                 element = "Email: %s" % element
             return {'comment': element}, NO_ERRORS
         else:
             return DO_NOTHING, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_NAD(cls, segment, template):
+    @with_compiled_check
+    def _process_NAD(cls, segment, values):
         serializer = Serializer()
         pool = Pool()
+        Party = pool.get('party.party')
         PartyIdentifier = pool.get('party.identifier')
         Address = pool.get('party.address')
-        if segment.elements[0] in ('MS', 'BY'):
-            edi_operational_point = segment.elements[1][0]
+        qualifier, edi_operational_point = values
+        # The code is missing when the element is not a list of components
+        if not isinstance(edi_operational_point, str):
+            edi_operational_point = None
+        references = cls._get_edi_references()
+        if qualifier in ('MS', 'BY'):
+            party_ids = (references.parties.get(edi_operational_point.upper())
+                if references and edi_operational_point else None)
+            if party_ids:
+                return {'MS': Party.browse(party_ids)}, NO_ERRORS
             identifiers = PartyIdentifier.search([
                     ('party.active', '=', True),
                     ('type', '=', 'edi_head'),
-                    ('code', 'ilike', edi_operational_point)])
+                    ('code', 'ilike', edi_operational_point)]
+                ) if edi_operational_point else []
             if not identifiers:
                 serialized_segment = serializer.serialize([segment])
                 msg = 'Party not found'
                 return DO_NOTHING, ['{}: {}'.format(msg, serialized_segment)]
             return {'MS': [x.party for x in identifiers]}, NO_ERRORS
-        elif segment.elements[0] == 'DP':
-            edi_operational_point = segment.elements[1][0]
-            if hasattr(Address, 'electronet_sale_point'):
-                field = 'electronet_sale_point'
-            else:
-                field = 'edi_ean'
-            address, = Address.search([
-                    ('active', '=', True),
-                    ('party.active', '=', True),
-                    (field, 'ilike', edi_operational_point)
-                    ], limit=1) or [None]
+        elif qualifier == 'DP':
+            address_ids = (
+                references.addresses.get(edi_operational_point.upper())
+                if references and edi_operational_point else None)
+            if address_ids:
+                return {'DP': Address(address_ids[0])}, NO_ERRORS
+            field = cls._get_edi_address_field()
+            address = None
+            if edi_operational_point:
+                address, = Address.search([
+                        ('active', '=', True),
+                        ('party.active', '=', True),
+                        (field, 'ilike', edi_operational_point)
+                        ], limit=1) or [None]
 
             if not address:
                 serialized_segment = serializer.serialize([segment])
@@ -269,12 +371,12 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
         return DO_NOTHING, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_CUX(cls, segment, template):
+    @with_compiled_check
+    def _process_CUX(cls, segment, values):
         pool = Pool()
         serializer = Serializer()
         Currency = pool.get('currency.currency')
-        currency_code = segment.elements[0][2]
+        currency_code, = values
         currency = Currency.search([('code', '=', currency_code)], limit=1)
         if not currency:
             serialized_segment = serializer.serialize([segment])
@@ -283,12 +385,102 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
         currency, = currency
         return {'currency': currency}, NO_ERRORS
 
+    @staticmethod
+    def _normalize_edi_ean(code):
+        if not isinstance(code, str):
+            return
+        code = code.replace(' ', '').replace('-', '').strip()
+        if not code.isdigit():
+            return
+        # GTIN-14 with a leading zero is the same number as the EAN-13
+        if len(code) == 14 and code.startswith('0'):
+            code = code[1:]
+        return code
+
     @classmethod
-    def _process_PIALIN(cls, segment, template):
+    def _get_edi_products(cls, detail, template):
+        """
+        Return the ids of the products of all the lines of a message indexed
+        by EAN and by code, so each line doesn't search its product.
+        :param template: The validators of the template by section and tag.
+        """
         pool = Pool()
         Product = pool.get('product.product')
+        ProductIdentifier = pool.get('product.identifier')
+
+        eans, codes = set(), set()
+        for linegroup in detail:
+            for segment in linegroup:
+                if (segment.tag not in ('LIN', 'PIA')
+                        or segment.tag not in template['detail'].keys()):
+                    continue
+                validator = compile_segment(template['detail'][segment.tag])
+                try:
+                    values = validator(segment.elements)
+                except (MissingFieldsError, IncorrectValueForField):
+                    continue
+                if segment.tag == 'LIN':
+                    code = cls._normalize_edi_ean(values[0])
+                    if code:
+                        eans.add(code)
+                elif isinstance(values[-1], str) and values[-1]:
+                    codes.add(values[-1])
+
+        products = {
+            'ean': {},
+            'code': {},
+            }
+        if eans:
+            # The codes may be stored as EAN-13 or as GTIN-14
+            identifiers = ProductIdentifier.search([
+                    ('type', '=', 'ean'),
+                    ('code', 'in', list(eans) + ['0' + c for c in eans
+                            if len(c) == 13]),
+                    ('product.active', '=', True),
+                    ])
+            for identifier in identifiers:
+                products['ean'].setdefault(
+                    cls._normalize_edi_ean(identifier.code),
+                    identifier.product.id)
+        references = cls._get_edi_references()
+        if references and codes:
+            for code in list(codes):
+                product_ids = references.products.get(code)
+                if product_ids:
+                    products['code'][code] = product_ids[0]
+                    codes.discard(code)
+        if codes:
+            for product in Product.search([('code', 'in', list(codes))]):
+                products['code'].setdefault(product.code, product.id)
+        return products
+
+    @classmethod
+    def _process_LINLIN(cls, segment, template, products=None):
         try:
-            validate_segment(segment.elements, template)
+            code, = compile_segment(template)(segment.elements)
+        except (MissingFieldsError, IncorrectValueForField):
+            # Partners that identify the products by PIA segment don't send
+            # the EAN in the LIN segment
+            return DO_NOTHING, NO_ERRORS
+        code = cls._normalize_edi_ean(code)
+        if not code:
+            return DO_NOTHING, NO_ERRORS
+        if products is None:
+            products = cls._get_edi_products([[segment]],
+                {'detail': {'LIN': template}})
+        product = products['ean'].get(code)
+        if not product:
+            serializer = Serializer()
+            serialized_segment = serializer.serialize([segment])
+            msg = 'No product found in segment'
+            return DO_NOTHING, ['{}: {}'.format(
+                    msg, str(serialized_segment))]
+        return {'product': product}, NO_ERRORS
+
+    @classmethod
+    def _process_PIALIN(cls, segment, template, products=None):
+        try:
+            _, code = compile_segment(template)(segment.elements)
         except MissingFieldsError:
             return DO_NOTHING, NO_ERRORS
         except IncorrectValueForField:
@@ -298,45 +490,51 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
             return DO_NOTHING, ['{}: {}'.format(
                         msg, str(serialized_segment))]
         else:
-            code = segment.elements[1][0]
-            product = Product.search([('code', '=', code)], limit=1)
+            if products is None:
+                products = cls._get_edi_products([[segment]],
+                    {'detail': {'PIA': template}})
+            product = products['code'].get(code)
             if not product:
                 serializer = Serializer()
                 serialized_segment = serializer.serialize([segment])
                 msg = 'No product found in segment'
                 return DO_NOTHING, ['{}: {}'.format(
                         msg, str(serialized_segment))]
-            return {'product': product[0].id}, NO_ERRORS
+            return {'product': product}, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_QTYLIN(cls, segment, template):
+    @with_compiled_check
+    def _process_QTYLIN(cls, segment, values):
         pool = Pool()
         Uom = pool.get('product.uom')
+        quantity, _ = values
+        # The unit is optional and it's the last component when it's sent,
+        # so it has no position in the template
         uom_value = UOMS_EDI_TO_TRYTON.get(segment.elements[0][-1], 'u')
         uom, = Uom.search([('symbol', '=', uom_value)], limit=1)
-        quantity = float(segment.elements[0][2])
+        quantity = float(quantity)
         return {'unit': uom, 'quantity': quantity}, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_DTMLIN(cls, segment, template):
-        date = datetime.strptime(segment.elements[0][2], '%Y%m%d')
+    @with_compiled_check
+    def _process_DTMLIN(cls, segment, values):
+        date = datetime.strptime(values[0], '%Y%m%d')
         return {'shipping_date': date}, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_PRILIN(cls, segment, template):
+    @with_compiled_check
+    def _process_PRILIN(cls, segment, values):
         pool = Pool()
         SaleLine = pool.get('sale.line')
 
         field = None
-        value = float(segment.elements[0][2])
-        qty_value = float(segment.elements[0][6])
+        qualifier, value, qty_value = values
+        value = float(value)
+        qty_value = float(qty_value)
         value = (value / qty_value) if qty_value > 0 else 0
-        if segment.elements[0][0] == 'AAA':
+        if qualifier == 'AAA':
             field = 'unit_price'
-        elif segment.elements[0][0] in ('AAB', 'INF'):
+        elif qualifier in ('AAB', 'INF'):
             # If the model SaleLine doesn't have the field base_price
             # means the module sale_discount was not installed.
             if hasattr(SaleLine, 'base_price'):
@@ -349,12 +547,12 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
         return {field: value}, NO_ERRORS
 
     @classmethod
-    @with_segment_check
-    def _process_PCDLIN(cls, segment, template):
+    @with_compiled_check
+    def _process_PCDLIN(cls, segment, values):
         pool = Pool()
         SaleLine = pool.get('sale.line')
         field = None
-        discount = Decimal(segment.elements[0][2]) / 100
+        discount = Decimal(values[0]) / 100
         # If the model SaleLine doesn't have the field discount1 means
         # the module sale_3_discounts was not installed.
         if hasattr(SaleLine, 'discount1'):
@@ -368,6 +566,219 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
 
         return {field: discount}, NO_ERRORS
 
+    @staticmethod
+    def _get_edi_address_field():
+        pool = Pool()
+        Address = pool.get('party.address')
+        if hasattr(Address, 'electronet_sale_point'):
+            return 'electronet_sale_point'
+        return 'edi_ean'
+
+    @classmethod
+    def _get_edi_references(cls):
+        """
+        Return the EDI references preloaded for the current database, or
+        those refreshed by the current transaction until it's committed
+        """
+        datamanager = Transaction().join(EdiDataManager())
+        if datamanager.references is not None:
+            return datamanager.references
+        with _edi_references_lock:
+            return _edi_references.get(Transaction().database.name)
+
+    @staticmethod
+    def _set_edi_references(database, references):
+        with _edi_references_lock:
+            current = _edi_references.get(database)
+            if current is None or current.updated <= references.updated:
+                _edi_references[database] = references
+
+    @classmethod
+    def _get_edi_references_domains(cls):
+        "Return the domains of the records of the EDI references"
+        field = cls._get_edi_address_field()
+        return {
+            'parties': [
+                ('type', '=', 'edi_head'),
+                ('code', 'not in', [None, '']),
+                ('party.active', '=', True),
+                ],
+            'addresses': [
+                (field, 'not in', [None, '']),
+                ('active', '=', True),
+                ('party.active', '=', True),
+                ],
+            'products': [
+                ('code', 'not in', [None, '']),
+                ('active', '=', True),
+                ('template.salable', '=', True),
+                ],
+            }
+
+    @classmethod
+    def preload_edi_references(cls):
+        """
+        Load the lookup maps of the party identifiers, the delivery point
+        addresses and the salable products used by the EDI messages.
+        The first call loads all the records, next calls only fetch the
+        records written since the previous one and count the records to
+        load them all again when some have been deleted. The maps refreshed
+        less than REFERENCES_REFRESH ago are returned as they are.
+        The maps changed by a transaction are used by the other ones once
+        it's committed.
+        """
+        transaction = Transaction()
+        database = transaction.database.name
+        datamanager = transaction.join(EdiDataManager())
+        now = datetime.now()
+        references = datamanager.references
+        shared = references is None
+        if shared:
+            with _edi_references_lock:
+                references = _edi_references.get(database)
+        if (references is not None
+                and now - references.updated < REFERENCES_REFRESH):
+            return references
+        with transaction.set_context(active_test=False):
+            if (references is not None
+                    and now - references.loaded <= REFERENCES_RELOAD):
+                changes = cls._get_edi_references_changes(references,
+                    references.updated - REFERENCES_OVERLAP)
+                # The shared maps are only modified by the transaction when
+                # it finds the same records
+                if changes and shared:
+                    references = references.copy()
+                    shared = False
+                cls._set_edi_references_changes(references, changes)
+                if not cls._check_edi_references(references):
+                    references = None
+            else:
+                references = None
+            if references is None:
+                references = EdiReferences()
+                references.loaded = now
+                shared = False
+                cls._set_edi_references_changes(references,
+                    cls._get_edi_references_changes(references))
+        references.updated = now
+        if not shared:
+            datamanager.references = references
+            datamanager.on_commit.append(
+                partial(cls._set_edi_references, database, references))
+            logger.info('EDI references of %s: %s party identifiers, '
+                '%s addresses and %s products', database,
+                len(references.parties), len(references.addresses),
+                len(references.products))
+        return references
+
+    @classmethod
+    def _get_edi_references_changes(cls, references, since=None):
+        """
+        Return the list of map name, record id, key and value of the records
+        written since the time, or of all the records if since is None, which
+        are not yet in the references
+        """
+        pool = Pool()
+        PartyIdentifier = pool.get('party.identifier')
+        Address = pool.get('party.address')
+        Product = pool.get('product.product')
+
+        def changed(*prefixes):
+            domain = ['OR']
+            for prefix in prefixes:
+                domain.append((prefix + 'write_date', '>=', since))
+                domain.append((prefix + 'create_date', '>=', since))
+            return domain
+
+        domains = cls._get_edi_references_domains()
+        if since is not None:
+            domains['parties'] = changed('', 'party.')
+            domains['addresses'] = changed('', 'party.')
+            domains['products'] = changed('', 'template.')
+
+        changes = []
+
+        def change(name, record_id, key, value):
+            if not getattr(references, name).has(record_id, key, value):
+                changes.append((name, record_id, key, value))
+
+        for identifier in PartyIdentifier.search(domains['parties']):
+            key = None
+            if (identifier.type == 'edi_head' and identifier.code
+                    and identifier.party.active):
+                key = identifier.code.upper()
+            change('parties', identifier.id, key, identifier.party.id)
+
+        field = cls._get_edi_address_field()
+        for address in Address.search(domains['addresses']):
+            code = getattr(address, field)
+            key = None
+            if code and address.active and address.party.active:
+                key = code.upper()
+            change('addresses', address.id, key, address.id)
+
+        for product in Product.search(domains['products']):
+            key = None
+            if product.code and product.active and product.template.salable:
+                key = product.code
+            change('products', product.id, key, product.id)
+        return changes
+
+    @staticmethod
+    def _set_edi_references_changes(references, changes):
+        for name, record_id, key, value in changes:
+            getattr(references, name).set(record_id, key, value)
+
+    @classmethod
+    def _check_edi_references(cls, references):
+        """
+        Return if the references have as many records as the database, which
+        is not the case when some have been deleted
+        """
+        pool = Pool()
+        PartyIdentifier = pool.get('party.identifier')
+        Address = pool.get('party.address')
+        Product = pool.get('product.product')
+
+        domains = cls._get_edi_references_domains()
+        return (
+            PartyIdentifier.search_count(domains['parties'])
+            == len(references.parties)
+            and Address.search_count(domains['addresses'])
+            == len(references.addresses)
+            and Product.search_count(domains['products'])
+            == len(references.products))
+
+    @classmethod
+    def get_edi_template(cls, template_name=None):
+        """
+        Return the EdiTemplate used to validate the EDI messages
+        :param template_name: File name of the template, by default the one
+            defined in the sale configuration.
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        if not template_name:
+            configuration = Configuration(1)
+            template_name = (configuration.template_sale_edi
+                or DEFAULT_TEMPLATE)
+        template_name = os.path.basename(template_name)
+        template_path = os.path.join(os.path.join(MODULE_PATH, 'templates'),
+            template_name)
+        if not os.path.isfile(template_path):
+            raise UserError(gettext(
+                    'sale_edi_electronet.msg_edi_template_not_found',
+                    template=template_name))
+        # The same instance is returned while the file is not modified, so
+        # its segments are compiled only once
+        mtime = os.path.getmtime(template_path)
+        key = (template_name, template_path)
+        cached = _edi_templates.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = _edi_templates[key] = (mtime,
+                EdiTemplate(template_name, template_path))
+        return cached[1]
+
     @classmethod
     def create_edi_sales(cls, template=DEFAULT_TEMPLATE):
         """
@@ -378,13 +789,451 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
         configuration = Configuration(1)
         errors_path = os.path.abspath(configuration.edi_errors_path)
         source_path = os.path.abspath(configuration.edi_source_path)
-        template_name = (configuration.template_sale_edi
-            or DEFAULT_TEMPLATE)
-        template_path = os.path.join(os.path.join(MODULE_PATH, 'templates'),
-            template_name)
-        template = EdiTemplate(template_name, template_path)
+        template = cls.get_edi_template()
+        cls.preload_edi_references()
         return cls.process_edi_inputs(source_path, errors_path, template)
 
+    @classmethod
+    def process_edi_inputs(cls, source_path, errors_path, template):
+        """
+        Create the sales of the EDI files found in source_path. The files of
+        each sender are sorted by the processing priority and the senders
+        are processed in turns, by quota, or in parallel by the queue as
+        defined in the sale configuration. The priority only sorts the files
+        of each sender, the urgent files of a sender wait for the turns of
+        the senders before it.
+        It replaces the scan of EdifactMixin to sort and group the files and
+        to remove them only once their sales are committed.
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        configuration = Configuration(1)
+
+        groups = cls.get_edi_input_files(source_path)
+        for sender, files in groups.items():
+            logger.info('EDI backlog of sender %s: %s files', sender,
+                len(files))
+        if configuration.edi_sender_parallel and len(groups) > 1:
+            template_name = cls._get_edi_template_name(template)
+            with Transaction().set_context(queue_name='sale_edi'):
+                for sender, files in groups.items():
+                    files = cls._claim_edi_files(source_path, files)
+                    if files:
+                        Configuration.__queue__.process_edi_sender_files(
+                            [configuration], sender, files, errors_path,
+                            template_name)
+            return []
+        quotas = parse_sender_quotas(configuration.edi_sender_quotas)
+        return cls._process_edi_files(interleave_by_sender(groups, quotas),
+            errors_path, template)
+
+    @staticmethod
+    def _get_edi_template_name(template):
+        "Return the file name of a template returned by get_edi_template"
+        for (template_name, _), (_, cached) in list(_edi_templates.items()):
+            if cached is template:
+                return template_name
+
+    @classmethod
+    def _claim_edi_files(cls, source_path, files):
+        """
+        Move the files to a new working directory of source_path, so they
+        can't be taken by another run, and return their new names. They are
+        moved back if the transaction is rolled back.
+        """
+        work_path = tempfile.mkdtemp(prefix='.edi_', dir=source_path)
+        datamanager = Transaction().join(EdiDataManager())
+        claimed = []
+        for fname in files:
+            claimed_fname = os.path.join(work_path, os.path.basename(fname))
+            try:
+                os.rename(fname, claimed_fname)
+            except FileNotFoundError:
+                continue
+            datamanager.on_abort.append(
+                partial(move_edi_file, claimed_fname, fname))
+            claimed.append(claimed_fname)
+        if not claimed:
+            remove_edi_work_path(work_path)
+        else:
+            datamanager.on_abort.append(
+                partial(remove_edi_work_path, work_path))
+        return claimed
+
+    @classmethod
+    def process_edi_sender_files(cls, sender, files, errors_path,
+            template_name=None):
+        """
+        Create the sales of the EDI files of a sender claimed by
+        _claim_edi_files, used by the queue task of the sale configuration to
+        process the senders in parallel. If the task fails, the files are
+        moved back to the source path to be processed by the next run.
+        """
+        template = cls.get_edi_template(template_name)
+        cls.preload_edi_references()
+        datamanager = Transaction().join(EdiDataManager())
+        work_paths = set()
+        for fname in files:
+            work_path = os.path.dirname(fname)
+            if work_path not in work_paths:
+                # The files are not recovered while the task processes them
+                try:
+                    os.utime(work_path)
+                except FileNotFoundError:
+                    pass
+            work_paths.add(work_path)
+            datamanager.on_abort.append(partial(move_edi_file, fname,
+                    os.path.join(os.path.dirname(work_path),
+                        os.path.basename(fname))))
+        sales = cls._process_edi_files([(sender, files)], errors_path,
+            template)
+        # The working directories are removed after their files
+        datamanager = Transaction().join(EdiDataManager())
+        for work_path in work_paths:
+            datamanager.on_commit.append(
+                partial(remove_edi_work_path, work_path))
+            datamanager.on_abort.append(
+                partial(remove_edi_work_path, work_path))
+        return sales
+
+    @classmethod
+    def _process_edi_files(cls, turns, errors_path, template):
+        """
+        Create the sales of a list of (sender, file names) turns and log the
+        throughput of each sender. Once the sales are committed the files are
+        removed and those with errors are moved to errors_path, so they are
+        processed again if the transaction fails.
+        With the edi_commit_turns context the transaction is committed after
+        each turn, so the sales of each sender are not delayed by the next
+        ones.
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        configuration = Configuration(1)
+        profile_threshold = (configuration.edi_profile_threshold
+            if configuration.edi_profile else None)
+        commit = Transaction().context.get('edi_commit_turns')
+
+        counters = OrderedDict()
+        for sender, files in turns:
+            counter = counters.setdefault(sender, {
+                    'files': 0,
+                    'processed': 0,
+                    'errors': 0,
+                    'sales': 0,
+                    'seconds': 0.0,
+                    })
+            counter['files'] += len(files)
+
+        sales = []
+        try:
+            for sender, files in turns:
+                counter = counters[sender]
+                datamanager = Transaction().join(EdiDataManager())
+                turn_sales = []
+                for fname in files:
+                    # The file may have been removed meanwhile
+                    if not os.path.isfile(fname):
+                        continue
+                    start = time.perf_counter()
+                    sale, errors = cls.process_edi_input_file(fname,
+                        errors_path, template,
+                        profile_threshold=profile_threshold)
+                    counter['seconds'] += time.perf_counter() - start
+                    counter['processed'] += 1
+                    if errors:
+                        counter['errors'] += 1
+                    if sale:
+                        counter['sales'] += 1
+                        turn_sales.append(sale)
+                    if errors:
+                        datamanager.on_commit.append(partial(move_edi_file,
+                                fname, os.path.join(errors_path,
+                                    os.path.basename(fname))))
+                    else:
+                        datamanager.on_commit.append(
+                            partial(remove_edi_file, fname))
+                sales.extend(turn_sales)
+                if commit:
+                    if turn_sales:
+                        cls._save_edi_sales(turn_sales)
+                    Transaction().commit()
+        finally:
+            for sender, counter in counters.items():
+                logger.info('EDI sender %s: %s of %s files processed '
+                    '(%s pending), %s with errors, %s sales, %.2f files/s',
+                    sender, counter['processed'], counter['files'],
+                    counter['files'] - counter['processed'],
+                    counter['errors'], counter['sales'],
+                    counter['processed'] / counter['seconds']
+                    if counter['seconds'] else 0)
+        # Without commits the sales are saved at once, after their numbers
+        # are reserved
+        if sales and not commit:
+            cls._save_edi_sales(sales)
+        return sales
+
+    @classmethod
+    def get_edi_input_files(cls, source_path):
+        """
+        Return the EDI files of source_path grouped by sender and sorted by
+        processing priority
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        configuration = Configuration(1)
+
+        cls._recover_edi_work_paths(source_path)
+        files = []
+        for fname in sorted(os.listdir(source_path)):
+            fname = os.path.join(source_path, fname)
+            if (os.path.splitext(fname)[1].lower() in KNOWN_EXTENSIONS
+                    and os.path.isfile(fname)):
+                files.append(fname)
+        headers = {}
+        if len(files) > 1:
+            for fname in files:
+                headers[fname] = peek_edi_header(cls._read_edi_file(fname))
+        priority = configuration.edi_priority
+        if priority and headers:
+            files.sort(key=lambda f: cls._get_edi_priority_key(priority,
+                    headers[f]))
+        groups = OrderedDict()
+        for fname in files:
+            sender = headers[fname].sender if headers else None
+            groups.setdefault(sender, []).append(fname)
+        return groups
+
+    @staticmethod
+    def _recover_edi_work_paths(source_path):
+        """
+        Move back to source_path the files of the working directories not
+        modified for WORK_PATH_TIMEOUT, left by the queue tasks which were
+        lost or failed before moving them back
+        """
+        limit = time.time() - WORK_PATH_TIMEOUT.total_seconds()
+        for name in os.listdir(source_path):
+            work_path = os.path.join(source_path, name)
+            if not name.startswith('.edi_') or not os.path.isdir(work_path):
+                continue
+            try:
+                if os.path.getmtime(work_path) > limit:
+                    continue
+                names = os.listdir(work_path)
+            except FileNotFoundError:
+                continue
+            for fname in names:
+                # A file sent again meanwhile is not overwritten
+                if os.path.exists(os.path.join(source_path, fname)):
+                    continue
+                logger.warning('Recovering EDI file %s', fname)
+                move_edi_file(os.path.join(work_path, fname),
+                    os.path.join(source_path, fname))
+            remove_edi_work_path(work_path)
+
+    @staticmethod
+    def _get_edi_priority_key(priority, header):
+        no_date = header.delivery_date is None
+        if priority == 'urgency':
+            return (no_date, header.delivery_date or '', header.lines)
+        return (header.lines, no_date, header.delivery_date or '')
+
+    @classmethod
+    def _read_edi_file(cls, fname):
+        with open(fname, 'rb') as fp:
+            return cls._decode_edi_payload(fp.read())
+
+    @classmethod
+    def process_edi_input_file(cls, fname, errors_path, template,
+            profile_threshold=None):
+        """
+        Create the sale of an EDI file and write its errors to errors_path.
+        Return the sale, not saved, and the errors. The file is not removed.
+        :param profile_threshold: Seconds from which the profile of the import
+            is saved to errors_path. The import isn't sampled if it's None.
+        """
+        data = cls._read_edi_file(fname)
+        sampler = None
+        if profile_threshold is not None:
+            sampler = StackSampler()
+            sampler.start()
+        start = time.perf_counter()
+        try:
+            sale, errors = cls.import_edi_input(data, template)
+        except EDI_INPUT_ERRORS as e:
+            sale, errors = NO_SALE, [str(e)]
+        finally:
+            if sampler:
+                sampler.stop()
+        elapsed = time.perf_counter() - start
+        if sampler and elapsed >= profile_threshold:
+            cls._write_edi_profile(fname, errors_path, sampler, elapsed,
+                peek_edi_header(data).lines)
+        if errors:
+            basename = os.path.splitext(os.path.basename(fname))[0]
+            error_fname = os.path.join(errors_path,
+                'error_{}.EDI'.format(basename))
+            with open(error_fname, 'w') as fp:
+                fp.write('\n'.join(str(x) for x in errors))
+        return sale, errors
+
+    @staticmethod
+    def _write_edi_profile(fname, errors_path, sampler, elapsed, lines):
+        basename = os.path.splitext(os.path.basename(fname))[0]
+        profile_fname = os.path.join(errors_path,
+            'profile_{}.txt'.format(basename))
+        logger.warning('EDI file %s with %s lines took %.2fs to import, '
+            'profile saved to %s', fname, lines, elapsed, profile_fname)
+        with open(profile_fname, 'w') as fp:
+            fp.write('File: {}\nLines: {}\nTime: {:.3f}s\n'.format(
+                    fname, lines, elapsed))
+            sampler.write(fp)
+
+    @classmethod
+    def import_edi_payloads(cls, payloads, template_name=None):
+        """
+        Create sales from EDI payloads already held in memory
+        :param payloads: EDI message or list of EDI messages as str or bytes.
+        :param template_name: File name of the template used to validate the
+            EDI messages, by default the one defined in the sale configuration.
+        Return a dictionary with the ids of the created sales and a list of
+        errors, each one with the index of its payload in the request. The
+        payloads which raise an error don't create any sale.
+        """
+        if isinstance(payloads, (str, bytes)):
+            payloads = [payloads]
+        template = cls.get_edi_template(template_name)
+        cls.preload_edi_references()
+
+        sales, errors = [], []
+        for index, payload in enumerate(payloads):
+            if isinstance(payload, bytes):
+                payload = cls._decode_edi_payload(payload)
+            try:
+                sale, sale_errors = cls.import_edi_input(payload, template)
+            except EDI_INPUT_ERRORS as e:
+                sale, sale_errors = NO_SALE, [str(e)]
+            if not sale and not sale_errors:
+                sale_errors = [
+                    gettext('sale_edi_electronet.msg_edi_not_order')]
+            if sale:
+                sales.append(sale)
+            if sale_errors:
+                errors.append({
+                        'index': index,
+                        'errors': [str(x) for x in sale_errors],
+                        })
+        if sales:
+            cls._save_edi_sales(sales)
+        return {
+            'sales': [s.id for s in sales],
+            'errors': errors,
+            }
+
+    @staticmethod
+    def _decode_edi_payload(payload):
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            return payload.decode('latin-1')
+
+    @classmethod
+    def _save_edi_sales(cls, sales):
+        "Number, save and apply the on changes of the lines of the sales"
+        cls.set_edi_numbers(sales)
+        cls.save(sales)
+        cls.apply_on_change_product_and_quantity_to_lines(sales)
+
+    @classmethod
+    def set_edi_numbers(cls, sales):
+        """
+        Set the number of the EDI sales, before they are saved, when the sale
+        configuration reserves them on import.
+        The numbers of the SQL sequences of PostgreSQL are taken from them,
+        which doesn't lock the sequence. Otherwise the numbers of each
+        company are reserved as a block with a single update of the sequence
+        in a separate transaction which is committed at once, so the sequence
+        isn't locked while the sales are imported. The sales of strict
+        sequences, which must not have gaps, are numbered when they are
+        quoted. If the import is rolled back the reserved numbers which are
+        left unused are logged.
+        """
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Sequence = pool.get('ir.sequence')
+        configuration = Configuration(1)
+        if not configuration.edi_reserve_numbers:
+            return
+
+        to_number = defaultdict(list)
+        for sale in sales:
+            if not sale.number:
+                to_number[sale.company.id].append(sale)
+        if not to_number:
+            return
+
+        numbers, blocks = {}, {}
+        for company_id, company_sales in to_number.items():
+            sequence = configuration.get_multivalue('sale_sequence',
+                company=company_id)
+            if not sequence or getattr(sequence, '_strict', False):
+                continue
+            if cls._reserve_edi_numbers_by_block(sequence):
+                blocks[company_id] = sequence.id
+            else:
+                numbers[company_id] = cls._reserve_edi_numbers(sequence,
+                    len(company_sales))
+        if blocks:
+            with Transaction().new_transaction() as transaction:
+                for company_id, sequence_id in blocks.items():
+                    numbers[company_id] = cls._reserve_edi_numbers(
+                        Sequence(sequence_id), len(to_number[company_id]))
+                transaction.commit()
+
+        datamanager = Transaction().join(EdiDataManager())
+        for company_id, company_numbers in numbers.items():
+            logger.info('Reserved sale numbers %s to %s for %s EDI sales',
+                company_numbers[0], company_numbers[-1], len(company_numbers))
+            datamanager.on_abort.append(partial(logger.warning,
+                    'EDI sales rolled back, the reserved sale numbers %s '
+                    'are left unused', ', '.join(company_numbers)))
+            for sale, number in zip(to_number[company_id], company_numbers):
+                sale.number = number
+
+    @staticmethod
+    def _reserve_edi_numbers_by_block(sequence):
+        # The SQL sequences don't lock the sequence, the timestamp ones can't
+        # be reserved in advance
+        return (sequence.type == 'incremental'
+            and not Transaction().database.has_sequence())
+
+    @classmethod
+    def _reserve_edi_numbers(cls, sequence, count):
+        """
+        Return the next count numbers of the sequence, reserved with a single
+        update of the sequence when it can be done by block
+        """
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        if not cls._reserve_edi_numbers_by_block(sequence):
+            return [sequence.get() for _ in range(count)]
+        # The sequence is reserved for the user who imports the sales
+        with Transaction().set_context(_check_access=False):
+            Sequence.lock([sequence])
+            sequence = Sequence(sequence.id)
+            number_next = sequence.number_next_internal
+            Sequence.write([sequence], {
+                    'number_next_internal': (number_next
+                        + count * sequence.number_increment),
+                    })
+        date = Transaction().context.get('date')
+        prefix = Sequence._process(sequence.prefix, date=date)
+        suffix = Sequence._process(sequence.suffix, date=date)
+        return ['%s%s%s' % (prefix,
+                '%%0%sd' % sequence.padding % (
+                    number_next + i * sequence.number_increment),
+                suffix) for i in range(count)]
+
     @classmethod
     def apply_on_change_product_and_quantity_to_lines(cls, sales):
         pool = Pool()
@@ -400,18 +1249,17 @@ class Sale(EdifactMixin, metaclass=PoolMeta):
     @classmethod
     def get_sales_from_edi_files(cls):
         '''Get orders from edi files'''
-        results = cls.create_edi_sales()
-        if results:
-            cls.apply_on_change_product_and_quantity_to_lines(results)
-        return results
+        return cls.create_edi_sales()
 
     @classmethod
     def get_sales_from_edi_files_cron(cls):
         """
         Cron get orders from edi files:
         - State: active
+        The sales of each turn of senders are committed.
         """
-        cls.get_sales_from_edi_files()
+        with Transaction().set_context(edi_commit_turns=True):
+            cls.get_sales_from_edi_files()
         return True
 
 
@@ -109,6 +109,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         'Topic :: Office/Business',
         ],
     license='GPL-3',
+    scripts=['bin/trytond-sale-edi-replay'],
     install_requires=requires,
     dependency_links=dependency_links,
     zip_safe=False,
@@ -2,8 +2,11 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import io
 import os
 import shutil
+import tempfile
+import time
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.pool import Pool
 from trytond.transaction import Transaction
@@ -12,12 +15,23 @@ from trytond.modules.company.tests import (create_company, set_company,
     CompanyTestMixin)
 from trytond.modules.account.tests import create_chart, get_fiscalyear
 from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.sale_edi_electronet.sale import (_edi_references,
+    REFERENCES_REFRESH, WORK_PATH_TIMEOUT)
+from trytond.modules.sale_edi_electronet.replay import (percentile,
+    summarize, diff)
+from trytond.modules.sale_edi_electronet.edi import (peek_edi_header,
+    compile_template, interleave_by_sender, parse_sender_quotas,
+    StackSampler, EdiDataManager, get_compiled_template)
+from edifact.errors import IncorrectValueForField, MissingFieldsError
+from edifact.message import Message
+from edifact.utils import validate_segment
 from decimal import Decimal
 
 
 TEST_FILES_DIR = os.path.abspath(
     'trytond/trytond/modules/sale_edi_electronet/tests/data/tmp')
 TEST_FILES_EXTENSION = '.txt'
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
 
 class SaleEdiElectronetTestCase(CompanyTestMixin, ModuleTestCase):
@@ -165,8 +179,8 @@ class SaleEdiElectronetTestCase(CompanyTestMixin, ModuleTestCase):
                     }])
         return term
 
-    @with_transaction()
-    def test_get_sales_from_edi_file(self):
+    def create_edi_data(self, company):
+        'Create the parties, identifiers and products used by the EDI files'
         pool = Pool()
         Party = pool.get('party.party')
         ProductUom = pool.get('product.uom')
@@ -174,8 +188,64 @@ class SaleEdiElectronetTestCase(CompanyTestMixin, ModuleTestCase):
         PartyIdentifier = pool.get('party.identifier')
         Product = pool.get('product.product')
         Category = pool.get('product.category')
-
         Tax = pool.get('account.tax')
+
+        self.create_fiscalyear_and_chart(company, None,
+            True)
+        # Create some parties
+        customer1, customer2, supplier1, supplier2 = self.create_parties(
+            company)
+        accounts = self.get_accounts(company)
+        expense = accounts.get('expense')
+        revenue = accounts.get('revenue')
+
+        tax, = Tax.search([], limit=1)
+        category = Category()
+        category.name = 'Accounting'
+        category.accounting = True
+        category.customer_taxes = [tax]
+        category.account_expense = expense
+        category.account_revenue = revenue
+        category.save()
+
+        term = self.create_payment_term()
+        customer, = Party.search([
+                ('name', '=', 'customer1'),
+                ], limit=1)
+        customer.customer_payment_term = term
+        customer.save()
+        identifier = PartyIdentifier()
+        identifier.type = 'edi_head'
+        identifier.code = 'PUNTO_VENTA'
+        identifier.party = customer
+        identifier.save()
+        address, = customer.addresses
+        address.edi_ean = 'PUNTO_VENTA'
+        address.save()
+
+        unit, = ProductUom.search([('name', '=', 'Unit')], limit=1)
+
+        for code in ('67310', 'REF1', 'REF3'):
+            product = Product()
+            template = ProductTemplate()
+            template.name = code
+            template.code = code
+            template.default_uom = unit
+            template.type = 'goods'
+            template.salable = True
+            template.list_price = Decimal('10')
+            template.cost_price_method = 'fixed'
+            template.account_category = category
+            template.sale_uom = unit
+            template.save()
+            product.template = template
+            product.cost_price = Decimal('5')
+            product.save()
+        return customer, term
+
+    @with_transaction()
+    def test_get_sales_from_edi_file(self):
+        pool = Pool()
         Sale = pool.get('sale.sale')
         SaleConfig = pool.get('sale.configuration')
 
@@ -189,61 +259,11 @@ class SaleEdiElectronetTestCase(CompanyTestMixin, ModuleTestCase):
         company = create_company(currency=currency)
         # add_currency_rate(currency, 1)
         with set_company(company):
-            self.create_fiscalyear_and_chart(company, None,
-                True)
-            # Create some parties
-            customer1, customer2, supplier1, supplier2 = self.create_parties(
-                company)
-            accounts = self.get_accounts(company)
-            expense = accounts.get('expense')
-            revenue = accounts.get('revenue')
-
-            tax, = Tax.search([], limit=1)
-            category = Category()
-            category.name = 'Accounting'
-            category.accounting = True
-            category.customer_taxes = [tax]
-            category.account_expense = expense
-            category.account_revenue = revenue
-            category.save()
-
-            term = self.create_payment_term()
-            customer, = Party.search([
-                    ('name', '=', 'customer1'),
-                    ], limit=1)
-            customer.customer_payment_term = term
-            customer.save()
-            identifier = PartyIdentifier()
-            identifier.type = 'edi_head'
-            identifier.code = 'PUNTO_VENTA'
-            identifier.party = customer
-            identifier.save()
-            address, = customer.addresses
-            address.edi_ean = 'PUNTO_VENTA'
-            address.save()
+            customer, term = self.create_edi_data(company)
             sale_cfg = SaleConfig(1)
             sale_cfg.edi_source_path = os.path.abspath(TEST_FILES_DIR)
             sale_cfg.save()
 
-            unit, = ProductUom.search([('name', '=', 'Unit')], limit=1)
-
-            for code in ('67310', 'REF1', 'REF3'):
-                product = Product()
-                template = ProductTemplate()
-                template.name = code
-                template.code = code
-                template.default_uom = unit
-                template.type = 'goods'
-                template.salable = True
-                template.list_price = Decimal('10')
-                template.cost_price_method = 'fixed'
-                template.account_category = category
-                template.sale_uom = unit
-                template.save()
-                product.template = template
-                product.cost_price = Decimal('5')
-                product.save()
-
             sales = Sale.get_sales_from_edi_files()
             self.assertTrue(sales)
             sale, = sales
@@ -262,7 +282,567 @@ class SaleEdiElectronetTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(line3.product.code, u'REF3')
             self.assertEqual(line3.quantity, 100.0)
             self.assertTrue(line3.taxes, True)
-            os.rmdir(TEST_FILES_DIR)
+            # The file is removed when the transaction is committed
+            self.assertTrue(os.listdir(TEST_FILES_DIR))
+            shutil.rmtree(TEST_FILES_DIR)
+
+    @with_transaction()
+    def test_get_sales_from_edi_files_with_errors(self):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleConfig = pool.get('sale.configuration')
+
+        with open(os.path.join(TEST_DATA_DIR, 'order.txt'), 'r') as fp:
+            payload = fp.read()
+        source_path = tempfile.mkdtemp()
+        errors_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_path)
+        self.addCleanup(shutil.rmtree, errors_path)
+        # The file in the middle of the batch has a line with a wrong date
+        for name, data in [
+                ('order1.txt', payload),
+                ('order2.txt', payload.replace(
+                        "DTM+2:20190119:102'\nPRI+INF:2.300",
+                        "DTM+2:20191319:102'\nPRI+INF:2.300")),
+                ('order3.txt', payload),
+                ]:
+            with open(os.path.join(source_path, name), 'w') as fp:
+                fp.write(data)
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        with set_company(company):
+            customer, term = self.create_edi_data(company)
+            sale_cfg = SaleConfig(1)
+            sale_cfg.edi_source_path = source_path
+            sale_cfg.edi_errors_path = errors_path
+            sale_cfg.save()
+
+            sales = Sale.get_sales_from_edi_files()
+            self.assertEqual(len(sales), 2)
+            for sale in sales:
+                self.assertEqual(sale.party, customer)
+                self.assertEqual(len(sale.lines), 3)
+            self.assertEqual(Sale.search_count([]), 2)
+            self.assertEqual(os.listdir(errors_path), ['error_order2.EDI'])
+            # No file is removed before the transaction is committed
+            self.assertEqual(sorted(os.listdir(source_path)),
+                ['order1.txt', 'order2.txt', 'order3.txt'])
+
+            # The file with errors is kept with its errors once committed
+            self.addCleanup(_edi_references.clear)
+            Transaction().join(EdiDataManager()).tpc_finish(Transaction())
+            self.assertEqual(os.listdir(source_path), [])
+            self.assertEqual(sorted(os.listdir(errors_path)),
+                ['error_order2.EDI', 'order2.txt'])
+
+    @with_transaction()
+    def test_import_edi_payloads(self):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        with open(os.path.join(TEST_DATA_DIR, 'order.txt'), 'rb') as fp:
+            payload = fp.read()
+        # The date of the second line is not valid once the first line is
+        # already imported
+        wrong_payload = payload.replace(
+            b"DTM+2:20190119:102'\nPRI+INF:2.300",
+            b"DTM+2:20191319:102'\nPRI+INF:2.300")
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        with set_company(company):
+            customer, term = self.create_edi_data(company)
+
+            result = Sale.import_edi_payloads([payload,
+                    b"UNB+UNOD:1+ORIGEN:ZZZ+DESTINO:ZZZ+190123:0957+1'",
+                    wrong_payload])
+            sale_id, = result['sales']
+            sale = Sale(sale_id)
+            self.assertEqual(sale.party, customer)
+            self.assertEqual(len(sale.lines), 3)
+            error1, error2 = result['errors']
+            self.assertEqual(error1['index'], 1)
+            self.assertTrue(error1['errors'])
+            self.assertEqual(error2['index'], 2)
+            self.assertEqual(Sale.search([]), [sale])
+
+            summary = summarize(sale)
+            self.assertEqual(summary['reference'], '35008715')
+            self.assertEqual(summary['party'], customer.rec_name)
+            self.assertEqual(summary['currency'], 'EUR')
+            self.assertEqual([line[:2] for line in summary['lines']], [
+                    ['67310', 201.0], ['REF1', 180.0], ['REF3', 100.0]])
+            self.assertEqual(summarize(None), None)
+
+    @with_transaction()
+    def test_import_edi_payloads_by_ean(self):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Product = pool.get('product.product')
+        ProductIdentifier = pool.get('product.identifier')
+
+        with open(os.path.join(TEST_DATA_DIR, 'order.txt'), 'r') as fp:
+            payload = fp.read()
+        # The first lines are only identified by their EAN
+        payload = payload.replace("LIN+1++:EN'\nPIA+5+67310:SA'",
+            "LIN+1++8412345678905:EN'")
+        payload = payload.replace("LIN+2++:EN'\nPIA+1+REF1:SA'",
+            "LIN+2++8412345678912:EN'")
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        with set_company(company):
+            self.create_edi_data(company)
+            product, = Product.search([('code', '=', '67310')])
+            identifier = ProductIdentifier()
+            identifier.product = product
+            identifier.type = 'ean'
+            identifier.code = '8412345678905'
+            identifier.save()
+            # The EAN-13 of the message matches the code stored as GTIN-14
+            product2, = Product.search([('code', '=', 'REF1')])
+            identifier = ProductIdentifier()
+            identifier.product = product2
+            identifier.type = 'ean'
+            identifier.code = '08412345678912'
+            identifier.save()
+
+            result = Sale.import_edi_payloads(payload)
+            self.assertFalse(result['errors'])
+            sale_id, = result['sales']
+            line1, line2, line3 = Sale(sale_id).lines
+            self.assertEqual(line1.product, product)
+            self.assertEqual(line1.quantity, 201.0)
+            self.assertEqual(line2.product, product2)
+
+    @with_transaction()
+    def test_preload_edi_references(self):
+        'Test the preload of the EDI references'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        PartyIdentifier = pool.get('party.identifier')
+        Product = pool.get('product.product')
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        with set_company(company):
+            customer, term = self.create_edi_data(company)
+            address, = customer.addresses
+            product, = Product.search([('code', '=', 'REF1')])
+
+            references = Sale.preload_edi_references()
+            self.assertEqual(references.parties.get('PUNTO_VENTA'),
+                [customer.id])
+            self.assertEqual(references.addresses.get('PUNTO_VENTA'),
+                [address.id])
+            self.assertEqual(references.products.get('REF1'), [product.id])
+            self.assertIs(Sale._get_edi_references(), references)
+
+            # The references refreshed recently are not refreshed again
+            address.edi_ean = 'OTRO'
+            address.save()
+            product.template.salable = False
+            product.template.save()
+            self.assertIs(Sale.preload_edi_references(), references)
+            self.assertEqual(references.addresses.get('PUNTO_VENTA'),
+                [address.id])
+
+            # Only the records written since the previous load are refreshed
+            references.updated -= REFERENCES_REFRESH
+            references = Sale.preload_edi_references()
+            self.assertEqual(references.addresses.get('PUNTO_VENTA'), [])
+            self.assertEqual(references.addresses.get('OTRO'), [address.id])
+            self.assertEqual(references.products.get('REF1'), [])
+            self.assertEqual(references.parties.get('PUNTO_VENTA'),
+                [customer.id])
+
+            # The deleted records are detected by their count
+            PartyIdentifier.delete(PartyIdentifier.search([
+                        ('party', '=', customer.id),
+                        ('type', '=', 'edi_head'),
+                        ]))
+            references.updated -= REFERENCES_REFRESH
+            references = Sale.preload_edi_references()
+            self.assertEqual(references.parties.get('PUNTO_VENTA'), [])
+            self.assertEqual(references.addresses.get('OTRO'), [address.id])
+
+    @with_transaction()
+    def test_get_edi_input_files(self):
+        'Test the order and the groups of the EDI files'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleConfig = pool.get('sale.configuration')
+
+        source_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_path)
+        for name, sender, delivery_date, lines in [
+                ('a.txt', 'S1', '20190120', 3),
+                ('b.txt', 'S1', '20190118', 5),
+                ('c.txt', 'S2', None, 1),
+                ('d.txt', 'S1', None, 2),
+                ('e.txt', 'S2', '20190119', 4),
+                ]:
+            data = ("UNB+UNOC:3+{}:14+DESTINO:14+190118:1200+1'\n"
+                "UNH+1+ORDERS:D:96A:UN:EAN008'\nBGM+220+1+9'\n").format(
+                sender)
+            if delivery_date:
+                data += "DTM+2:{}:102'\n".format(delivery_date)
+            for line in range(lines):
+                data += "LIN+{}++:EN'\n".format(line + 1)
+            data += "UNS+S'\n"
+            with open(os.path.join(source_path, name), 'w') as fp:
+                fp.write(data)
+
+        def get_files(priority):
+            sale_cfg = SaleConfig(1)
+            sale_cfg.edi_priority = priority
+            sale_cfg.save()
+            return [(sender, [os.path.basename(f) for f in files])
+                for sender, files in Sale.get_edi_input_files(
+                    source_path).items()]
+
+        self.assertEqual(get_files(None), [
+                ('S1', ['a.txt', 'b.txt', 'd.txt']),
+                ('S2', ['c.txt', 'e.txt']),
+                ])
+        self.assertEqual(get_files('urgency'), [
+                ('S1', ['b.txt', 'a.txt', 'd.txt']),
+                ('S2', ['e.txt', 'c.txt']),
+                ])
+        self.assertEqual(get_files('size'), [
+                ('S2', ['c.txt', 'e.txt']),
+                ('S1', ['d.txt', 'a.txt', 'b.txt']),
+                ])
+
+    @with_transaction()
+    def test_claim_edi_files(self):
+        'Test the claim of the EDI files queued by sender'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        source_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_path)
+        files = []
+        for name in ['order1.txt', 'order2.txt']:
+            fname = os.path.join(source_path, name)
+            with open(fname, 'w') as fp:
+                fp.write("UNB+UNOD:1+ORIGEN:ZZZ+DESTINO:ZZZ+190123:0957+1'")
+            files.append(fname)
+
+        claimed = Sale._claim_edi_files(source_path, files)
+        self.assertEqual([os.path.basename(f) for f in claimed],
+            ['order1.txt', 'order2.txt'])
+        self.assertTrue(all(os.path.isfile(f) for f in claimed))
+        work_path, = os.listdir(source_path)
+        self.assertTrue(work_path.startswith('.'))
+        self.assertEqual(Sale.get_edi_input_files(source_path), {})
+        # The files are claimed only once
+        self.assertEqual(Sale._claim_edi_files(source_path, files), [])
+
+        # The files are moved back when the transaction is rolled back
+        Transaction().join(EdiDataManager()).abort(Transaction())
+        self.assertEqual(sorted(os.listdir(source_path)),
+            ['order1.txt', 'order2.txt'])
+
+        # The files left by a lost task are recovered after a while
+        claimed = Sale._claim_edi_files(source_path, files)
+        work_path = os.path.dirname(claimed[0])
+        modified = time.time() - WORK_PATH_TIMEOUT.total_seconds() - 1
+        os.utime(work_path, (modified, modified))
+        groups = Sale.get_edi_input_files(source_path)
+        self.assertEqual([os.path.basename(f)
+                for files in groups.values() for f in files],
+            ['order1.txt', 'order2.txt'])
+        self.assertEqual(sorted(os.listdir(source_path)),
+            ['order1.txt', 'order2.txt'])
+
+    @with_transaction()
+    def test_process_edi_inputs_in_parallel(self):
+        'Test the EDI files of each sender processed by a queue task'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleConfig = pool.get('sale.configuration')
+        Queue = pool.get('ir.queue')
+
+        with open(os.path.join(TEST_DATA_DIR, 'order.txt'), 'r') as fp:
+            payload = fp.read()
+        source_path = tempfile.mkdtemp()
+        errors_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_path)
+        self.addCleanup(shutil.rmtree, errors_path)
+        for name, sender in [
+                ('order1.txt', 'PUNTO_VENTA'),
+                ('order2.txt', 'OTRO'),
+                ]:
+            with open(os.path.join(source_path, name), 'w') as fp:
+                fp.write(payload.replace('UNB+UNOD:1+PUNTO_VENTA:',
+                        'UNB+UNOD:1+{}:'.format(sender)))
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        with set_company(company):
+            customer, term = self.create_edi_data(company)
+            sale_cfg = SaleConfig(1)
+            sale_cfg.edi_source_path = source_path
+            sale_cfg.edi_errors_path = errors_path
+            sale_cfg.edi_sender_parallel = True
+            sale_cfg.save()
+
+            self.assertEqual(Sale.get_sales_from_edi_files(), [])
+            # The files of each sender are claimed by a task
+            tasks = Queue.search([('name', '=', 'sale_edi')])
+            self.assertEqual(len(tasks), 2)
+            self.assertEqual(Sale.get_edi_input_files(source_path), {})
+
+            for task in tasks:
+                task.run()
+            sales = Sale.search([])
+            self.assertEqual(len(sales), 2)
+            for sale in sales:
+                self.assertEqual(sale.party, customer)
+                self.assertEqual(len(sale.lines), 3)
+
+            # The files and the working directories are removed once
+            # committed
+            self.addCleanup(_edi_references.clear)
+            Transaction().join(EdiDataManager()).tpc_finish(Transaction())
+            self.assertEqual(os.listdir(source_path), [])
+            self.assertEqual(os.listdir(errors_path), [])
+
+    @with_transaction()
+    def test_set_edi_numbers(self):
+        'Test the numbers of the EDI sales reserved on import'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleConfig = pool.get('sale.configuration')
+        Sequence = pool.get('ir.sequence')
+
+        with open(os.path.join(TEST_DATA_DIR, 'order.txt'), 'rb') as fp:
+            payload = fp.read()
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        with set_company(company):
+            self.create_edi_data(company)
+            sale_cfg = SaleConfig(1)
+            sale_cfg.edi_reserve_numbers = True
+            sale_cfg.save()
+            sequence = sale_cfg.get_multivalue('sale_sequence',
+                company=company.id)
+            number_next = sequence.number_next
+
+            result = Sale.import_edi_payloads([payload, payload])
+            sale1, sale2 = Sale.browse(result['sales'])
+            self.assertEqual(sale1.number, str(number_next))
+            self.assertEqual(sale2.number, str(number_next + 1))
+            self.assertEqual(Sequence(sequence.id).number_next,
+                number_next + 2)
+
+            # The number is kept when the sale is quoted
+            Sale.quote([sale1])
+            self.assertEqual(sale1.number, str(number_next))
+
+    @with_transaction()
+    def test_reserve_edi_numbers(self):
+        'Test the reservation of the sale numbers'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Sequence = pool.get('ir.sequence')
+        ModelData = pool.get('ir.model.data')
+
+        sequence = Sequence(
+            name='EDI Sales',
+            sequence_type=ModelData.get_id('sale', 'sequence_type_sale'),
+            prefix='S',
+            padding=3,
+            number_next=5,
+            number_increment=2)
+        sequence.save()
+
+        self.assertEqual(Sale._reserve_edi_numbers(sequence, 3),
+            ['S005', 'S007', 'S009'])
+        self.assertEqual(Sequence(sequence.id).get(), 'S011')
+
+    def test_replay_report(self):
+        'Test the report of the replay'
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 90), 4)
+        self.assertEqual(percentile([1, 2, 3, 4], 100), 4)
+        self.assertEqual(percentile([1, 2, 3, 4], 0), 1)
+
+        sale = {'reference': '1', 'lines': [['A', 1.0]]}
+        previous = {
+            'a.txt': {'errors': [], 'sale': sale},
+            'b.txt': {'errors': [], 'sale': sale},
+            'c.txt': {'errors': [], 'sale': sale},
+            }
+        current = {
+            'a.txt': {'errors': [], 'sale': sale},
+            'b.txt': {'errors': ['Error'], 'sale': dict(sale,
+                    lines=[['A', 2.0]])},
+            'd.txt': {'errors': [], 'sale': None},
+            }
+        self.assertEqual(diff(previous, current), [
+                "b.txt: errors [] -> ['Error']",
+                "b.txt: lines [['A', 1.0]] -> [['A', 2.0]]",
+                'c.txt: not replayed',
+                'd.txt: not replayed before',
+                ])
+
+    def test_peek_edi_header(self):
+        'Test peek_edi_header'
+        with open(os.path.join(TEST_DATA_DIR, 'order.txt'), 'r') as fp:
+            header = peek_edi_header(fp.read())
+        self.assertEqual(header.delivery_date, '20190119')
+        self.assertEqual(header.lines, 3)
+        self.assertEqual(header.sender, 'PUNTO_VENTA')
+
+        header = peek_edi_header(
+            "UNA:+.? 'UNH+1+ORDERS:D:96A:UN:EAN008'BGM+220+1+9'")
+        self.assertEqual(header.delivery_date, None)
+        self.assertEqual(header.lines, 0)
+        self.assertEqual(header.sender, None)
+
+    def test_stack_sampler(self):
+        'Test StackSampler'
+        def busy_loop():
+            start = time.perf_counter()
+            while time.perf_counter() - start < 0.1:
+                sum(range(1000))
+
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        busy_loop()
+        sampler.stop()
+        self.assertTrue(sampler.samples)
+        stats = {f.split('(')[-1]: (total, own)
+            for f, total, own in sampler.get_stats()}
+        # Most of the time is spent in the loop, called by the test
+        total, own = stats['busy_loop)']
+        self.assertGreater(own, 0)
+        self.assertGreaterEqual(stats['test_stack_sampler)'][0], total)
+        output = io.StringIO()
+        sampler.write(output)
+        self.assertIn('(busy_loop)', output.getvalue())
+
+    @with_transaction()
+    def test_process_edi_input_file_profile(self):
+        'Test the profile of the slow EDI files'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        source_path = tempfile.mkdtemp()
+        errors_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_path)
+        self.addCleanup(shutil.rmtree, errors_path)
+        fname = os.path.join(source_path, 'order.txt')
+        with open(fname, 'w') as fp:
+            fp.write("UNB+UNOD:1+ORIGEN:ZZZ+DESTINO:ZZZ+190123:0957+1'")
+        template = Sale.get_edi_template()
+
+        Sale.process_edi_input_file(fname, errors_path, template)
+        Sale.process_edi_input_file(fname, errors_path, template,
+            profile_threshold=3600)
+        self.assertEqual(os.listdir(errors_path), [])
+
+        Sale.process_edi_input_file(fname, errors_path, template,
+            profile_threshold=0)
+        self.assertEqual(os.listdir(errors_path), ['profile_order.txt'])
+        with open(os.path.join(errors_path, 'profile_order.txt')) as fp:
+            profile = fp.read()
+        self.assertTrue(profile.startswith('File: {}\nLines: 0\n'.format(
+                    fname)))
+        self.assertIn('Samples: ', profile)
+
+    @with_transaction()
+    def test_process_nad_without_components(self):
+        'Test the NAD segments without the list of components of the code'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        validator = get_compiled_template(
+            Sale.get_edi_template())['header']['NAD']
+        message = Message.from_str("UNH+1+ORDERS:D:96A:UN:EAN008'"
+            "NAD+MS+8412345000001'NAD+DP+8412345000001'")
+        ms, dp = [s for s in message.segments if s.tag == 'NAD']
+        _, errors = Sale._process_NAD(ms, validator)
+        error, = errors
+        self.assertTrue(error.startswith('Party not found'))
+        _, errors = Sale._process_NAD(dp, validator)
+        error, = errors
+        self.assertTrue(error.startswith('Addresses not found'))
+
+    def test_interleave_by_sender(self):
+        'Test interleave_by_sender'
+        quotas = parse_sender_quotas('a=2\n')
+        self.assertEqual(interleave_by_sender({
+                    'A': ['a1', 'a2', 'a3', 'a4', 'a5'],
+                    'B': ['b1', 'b2'],
+                    None: ['c1'],
+                    }, quotas), [
+                ('A', ['a1', 'a2']), ('B', ['b1']), (None, ['c1']),
+                ('A', ['a3', 'a4']), ('B', ['b2']),
+                ('A', ['a5']),
+                ])
+        with self.assertRaises(ValueError):
+            parse_sender_quotas('A=0')
+
+    def test_compile_template(self):
+        'Test compile_template'
+        validators = compile_template({
+                'header': {
+                    'BGM': ['220', '!value', '9'],
+                    'NAD': [('BY', 'DP', 'MS'), ['!value']],
+                    },
+                'detail': {
+                    'DTM': [['2', '', '!value', '', '102']],
+                    },
+                })
+        self.assertEqual(
+            validators['header']['BGM'](['220', '35008715', '9']),
+            ('35008715',))
+        self.assertEqual(
+            validators['header']['NAD'](['DP', ['PUNTO_VENTA']]),
+            ('DP', 'PUNTO_VENTA'))
+        with self.assertRaises(IncorrectValueForField):
+            validators['header']['BGM'](['221', '35008715', '9'])
+        self.assertEqual(validators['resume'], {})
+        # The code is not a list of components
+        self.assertEqual(
+            validators['header']['NAD'](['MS', '8412345000001']),
+            ('MS', None))
+
+        def check(validator, elements):
+            'Return the errors of the validator and of validate_segment'
+            errors = []
+            for validate in [validator,
+                    lambda e: validate_segment(e, validator.template)]:
+                try:
+                    validate(elements)
+                except (MissingFieldsError, IncorrectValueForField) as e:
+                    errors.append(e.__class__)
+                else:
+                    errors.append(None)
+            return errors
+
+        dtm = validators['detail']['DTM']
+        for elements in [
+                [['2', '', '20190119', '', '102']],
+                # Empty positions with a value
+                [['2', 'X', '20190119', '', '102']],
+                [['2', '', '20190119', 'X', '102']],
+                # Empty value
+                [['2', '', '', '', '102']],
+                [['2', '', None, '', '102']],
+                [['2', '', '20190119']],
+                [['3', '', '20190119', '', '102']],
+                ]:
+            errors, expected = check(dtm, elements)
+            self.assertEqual(errors, expected, elements)
+        self.assertEqual(dtm([['2', '', '20190119', '', '102']]),
+            ('20190119',))
 
 
 del ModuleTestCase